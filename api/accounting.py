@@ -0,0 +1,241 @@
+import math
+import time
+import atexit
+import logging
+import threading
+from collections import deque
+from PIL import Image
+
+
+# Gemini bills an image of at most 384x384 as 258 tokens; larger images are
+# tiled into 768x768 crops at 258 tokens each.
+IMAGE_TOKENS_PER_TILE = 258
+IMAGE_SMALL_SIDE = 384
+IMAGE_TILE_SIDE = 768
+# Rough characters-per-token ratio used to size prompts before the call
+CHARS_PER_TOKEN = 4
+# Bucket for clients seen after the store's client limit is reached
+OVERFLOW_CLIENT = "other"
+
+
+class TokenBudgetExceeded(ValueError):
+    """Raised when a prompt is still over its token budget after downscaling images."""
+
+
+class UsageScope:
+    """Who a model call is made for: the endpoint, the client and its token budget.
+
+    Created once per request and passed to every model call alongside the
+    request's Deadline.
+    """
+
+    def __init__(self, endpoint: str, client: str, token_budget: int | None = None):
+        self.endpoint = endpoint
+        self.client = client
+        self.token_budget = token_budget
+
+
+def estimate_image_tokens(img: Image.Image) -> int:
+    width, height = img.size
+    if width <= IMAGE_SMALL_SIDE and height <= IMAGE_SMALL_SIDE:
+        return IMAGE_TOKENS_PER_TILE
+    tiles = math.ceil(width / IMAGE_TILE_SIDE) * math.ceil(height / IMAGE_TILE_SIDE)
+    return IMAGE_TOKENS_PER_TILE * tiles
+
+
+def estimate_text_tokens(text: str) -> int:
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def estimate_tokens(content) -> int:
+    items = content if isinstance(content, (list, tuple)) else [content]
+    total = 0
+    for item in items:
+        if isinstance(item, Image.Image):
+            total += estimate_image_tokens(item)
+        else:
+            total += estimate_text_tokens(str(item))
+    return total
+
+
+def fit_to_budget(content, budget: int | None):
+    """Fit a prompt (str or [prompt, image, ...]) into an estimated token budget.
+
+    Images are downscaled, down to the single-tile size. Text is never cut, since
+    it carries the user's input; if it still does not fit, TokenBudgetExceeded is
+    raised so the caller can reject the request. Returns (content, adjusted).
+    """
+    if not budget or estimate_tokens(content) <= budget:
+        return content, False
+
+    is_list = isinstance(content, (list, tuple))
+    items = list(content) if is_list else [content]
+
+    # Downscale the most expensive image until it fits or reaches one tile
+    while estimate_tokens(items) > budget:
+        images = [(estimate_image_tokens(it), i) for i, it in enumerate(items) if isinstance(it, Image.Image)]
+        images = [(cost, i) for cost, i in images if cost > IMAGE_TOKENS_PER_TILE]
+        if not images:
+            break
+        _, idx = max(images)
+        img = items[idx].copy()
+        img.thumbnail((max(1, img.width // 2), max(1, img.height // 2)))
+        items[idx] = img
+
+    estimated = estimate_tokens(items)
+    if estimated > budget:
+        raise TokenBudgetExceeded(f"Input of about {estimated} tokens exceeds the {budget}-token budget.")
+
+    return (items if is_list else items[0]), True
+
+
+class UsageStore:
+    """Rolling in-memory view of model usage, periodically flushed to SQLite.
+
+    Every call is kept for ``window_seconds`` so recent totals and the most
+    expensive calls can be inspected; totals per (endpoint, model, client) are
+    accumulated and flushed into the UsageAggregate table by the first call
+    after ``flush_interval`` has passed, and when the process exits. At most
+    ``max_clients`` distinct clients are tracked at a time; a client's slot is
+    freed once its calls leave the window and its totals are flushed. Clients
+    beyond the limit share one bucket.
+    """
+
+    def __init__(self, window_seconds: float = 3600, flush_interval: float = 60, top_n: int = 10,
+                 max_clients: int = 1000):
+        self.window_seconds = window_seconds
+        self.flush_interval = flush_interval
+        self.top_n = top_n
+        self.max_clients = max_clients
+        self._lock = threading.Lock()
+        self._events = deque()
+        self._pending = {}
+        self._clients = set()
+        self._last_flush = time.monotonic()
+
+    def record(self, scope: UsageScope | None, model: str, usage_metadata=None, image_bytes: int = 0,
+               adjusted: bool = False):
+        prompt_tokens = int(getattr(usage_metadata, "prompt_token_count", None) or 0)
+        output_tokens = int(getattr(usage_metadata, "candidates_token_count", None) or 0)
+        total_tokens = int(getattr(usage_metadata, "total_token_count", None) or (prompt_tokens + output_tokens))
+        client = scope.client if scope else "unknown"
+        event = {
+            "timestamp": time.time(),
+            "endpoint": scope.endpoint if scope else "unknown",
+            "model": model,
+            "prompt_tokens": prompt_tokens,
+            "output_tokens": output_tokens,
+            "total_tokens": total_tokens,
+            "image_bytes": int(image_bytes),
+            "adjusted": bool(adjusted),
+        }
+        with self._lock:
+            # Prune first so clients that aged out free their slot for this one
+            self._prune()
+            if client not in self._clients:
+                if len(self._clients) < self.max_clients:
+                    self._clients.add(client)
+                else:
+                    client = OVERFLOW_CLIENT
+            event["client"] = client
+            key = (event["endpoint"], event["model"], client)
+            self._events.append(event)
+            totals = self._pending.setdefault(key, _empty_totals())
+            _add_event(totals, event)
+            due = time.monotonic() - self._last_flush >= self.flush_interval
+        if due:
+            self.flush()
+
+    def _prune(self):
+        cutoff = time.time() - self.window_seconds
+        pruned = False
+        while self._events and self._events[0]["timestamp"] < cutoff:
+            self._events.popleft()
+            pruned = True
+        if pruned:
+            self._refresh_clients()
+
+    def _refresh_clients(self):
+        """Count only clients still in the window or awaiting a flush towards ``max_clients``."""
+        clients = {event["client"] for event in self._events}
+        clients.update(client for _, _, client in self._pending)
+        clients.discard(OVERFLOW_CLIENT)
+        self._clients = clients
+
+    def rolling(self, filters: dict | None = None) -> dict:
+        """Aggregates and the most expensive calls within the rolling window.
+
+        ``filters`` maps ``endpoint``/``model``/``client`` to a required value and
+        is applied before the most expensive calls are picked.
+        """
+        filters = filters or {}
+        with self._lock:
+            self._prune()
+            events = [e for e in self._events if all(e[key] == value for key, value in filters.items())]
+        grouped = {}
+        for event in events:
+            key = (event["endpoint"], event["model"], event["client"])
+            _add_event(grouped.setdefault(key, _empty_totals()), event)
+        aggregates = [
+            {"endpoint": endpoint, "model": model, "client": client, **totals}
+            for (endpoint, model, client), totals in sorted(grouped.items())
+        ]
+        most_expensive = sorted(events, key=lambda e: e["total_tokens"], reverse=True)[:self.top_n]
+        return {"window_seconds": self.window_seconds, "aggregates": aggregates, "most_expensive": most_expensive}
+
+    def flush(self):
+        """Add pending totals into the UsageAggregate table."""
+        from django.db import transaction
+        from django.db.models import F
+        from django.utils import timezone
+        from .models import UsageAggregate
+
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_flush = time.monotonic()
+            self._refresh_clients()
+        if not pending:
+            return
+        try:
+            with transaction.atomic():
+                for (endpoint, model, client), totals in pending.items():
+                    row, _ = UsageAggregate.objects.get_or_create(endpoint=endpoint, model=model, client=client)
+                    UsageAggregate.objects.filter(pk=row.pk).update(
+                        updated_at=timezone.now(),
+                        **{field: F(field) + value for field, value in totals.items()}
+                    )
+        except Exception as e:
+            logging.error(f"Error flushing usage aggregates: {str(e)}")
+            # Keep the totals for the next flush rather than losing them
+            with self._lock:
+                for key, totals in pending.items():
+                    current = self._pending.setdefault(key, _empty_totals())
+                    for field, value in totals.items():
+                        current[field] += value
+
+
+def _empty_totals() -> dict:
+    return {"calls": 0, "prompt_tokens": 0, "output_tokens": 0, "total_tokens": 0, "image_bytes": 0, "adjusted_calls": 0}
+
+
+def _add_event(totals: dict, event: dict):
+    totals["calls"] += 1
+    totals["prompt_tokens"] += event["prompt_tokens"]
+    totals["output_tokens"] += event["output_tokens"]
+    totals["total_tokens"] += event["total_tokens"]
+    totals["image_bytes"] += event["image_bytes"]
+    totals["adjusted_calls"] += int(event["adjusted"])
+
+
+def _build_store() -> UsageStore:
+    from django.conf import settings
+    return UsageStore(
+        window_seconds=getattr(settings, "USAGE_WINDOW_SECONDS", 3600),
+        flush_interval=getattr(settings, "USAGE_FLUSH_INTERVAL_SECONDS", 60),
+        max_clients=getattr(settings, "USAGE_MAX_CLIENTS", 1000),
+    )
+
+
+usage_store = _build_store()
+# Don't lose totals recorded since the last interval flush when the worker exits
+atexit.register(usage_store.flush)
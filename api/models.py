@@ -0,0 +1,35 @@
+from django.db import models
+
+
+class UsageAggregate(models.Model):
+    """Running Gemini usage totals per endpoint, model and client."""
+
+    endpoint = models.CharField(max_length=100)
+    model = models.CharField(max_length=100)
+    client = models.CharField(max_length=255)
+    calls = models.PositiveBigIntegerField(default=0)
+    prompt_tokens = models.PositiveBigIntegerField(default=0)
+    output_tokens = models.PositiveBigIntegerField(default=0)
+    total_tokens = models.PositiveBigIntegerField(default=0)
+    image_bytes = models.PositiveBigIntegerField(default=0)
+    adjusted_calls = models.PositiveBigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["endpoint", "model", "client"], name="unique_usage_aggregate"),
+        ]
+
+    def to_dict(self) -> dict:
+        return {
+            "endpoint": self.endpoint,
+            "model": self.model,
+            "client": self.client,
+            "calls": self.calls,
+            "prompt_tokens": self.prompt_tokens,
+            "output_tokens": self.output_tokens,
+            "total_tokens": self.total_tokens,
+            "image_bytes": self.image_bytes,
+            "adjusted_calls": self.adjusted_calls,
+            "updated_at": self.updated_at.isoformat() if self.updated_at else None,
+        }
@@ -0,0 +1,209 @@
+import os
+import time
+import threading
+from types import SimpleNamespace
+from unittest import mock
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from django.test import RequestFactory, SimpleTestCase, override_settings
+from PIL import Image
+
+# api.utils builds a Gemini client at import time; no request is sent in these tests
+os.environ.setdefault("GEMINI_API_KEY", "test-key")
+
+from .accounting import OVERFLOW_CLIENT, TokenBudgetExceeded, UsageScope, UsageStore, estimate_tokens, fit_to_budget
+from .utils import Deadline, DeadlineExceeded, JSONArrayStreamParser, _download_image
+from .views import _usage_scope
+
+
+def _feed_in_chunks(parser, text, size):
+    items = []
+    for i in range(0, len(text), size):
+        items.extend(parser.feed(text[i:i + size]))
+    return items
+
+
+class JSONArrayStreamParserTests(SimpleTestCase):
+    def test_parses_items_across_chunk_boundaries(self):
+        text = '[{"question": "1+1", "answer": "2"}, {"question": "2+2", "answer": "4"}]'
+        for size in (1, 3, 7, len(text)):
+            parser = JSONArrayStreamParser()
+            self.assertEqual(
+                _feed_in_chunks(parser, text, size),
+                [{"question": "1+1", "answer": "2"}, {"question": "2+2", "answer": "4"}],
+            )
+            self.assertTrue(parser.closed)
+
+    def test_each_item_is_returned_as_soon_as_it_closes(self):
+        parser = JSONArrayStreamParser()
+        self.assertEqual(parser.feed('[{"question": "a", "answer": "b"}, {"quest'), [{"question": "a", "answer": "b"}])
+        self.assertEqual(parser.feed('ion": "c", "answer": "d"}]'), [{"question": "c", "answer": "d"}])
+
+    def test_braces_and_quotes_inside_strings(self):
+        text = '[{"question": "Is \\"{x}]\\" a set?", "answer": "[1, {2}]"}]'
+        parser = JSONArrayStreamParser()
+        self.assertEqual(
+            _feed_in_chunks(parser, text, 1),
+            [{"question": 'Is "{x}]" a set?', "answer": "[1, {2}]"}],
+        )
+
+    def test_escaped_backslash_before_closing_quote(self):
+        parser = JSONArrayStreamParser()
+        self.assertEqual(parser.feed('[{"question": "a\\\\", "answer": "}"}]'), [{"question": "a\\", "answer": "}"}])
+
+    def test_malformed_item_is_skipped(self):
+        parser = JSONArrayStreamParser()
+        items = parser.feed('[{"question": oops}, {"question": "q", "answer": "a"}]')
+        self.assertEqual(items, [{"question": "q", "answer": "a"}])
+        self.assertEqual(parser.errors, 1)
+
+    def test_ignores_text_around_the_array(self):
+        parser = JSONArrayStreamParser()
+        items = _feed_in_chunks(parser, '```json\n[{"question": "q", "answer": "a"}]\n```\n[{"x": 1}]', 4)
+        self.assertEqual(items, [{"question": "q", "answer": "a"}])
+
+
+class FitToBudgetTests(SimpleTestCase):
+    def test_under_budget_is_unchanged(self):
+        self.assertEqual(fit_to_budget("solve 2x = 4", 100), ("solve 2x = 4", False))
+        self.assertEqual(fit_to_budget("x" * 10_000, None), ("x" * 10_000, False))
+
+    def test_text_is_never_trimmed(self):
+        prompt = "Problem: " + "x" * 400
+        with self.assertRaises(TokenBudgetExceeded):
+            fit_to_budget(prompt, 10)
+        with self.assertRaises(TokenBudgetExceeded):
+            fit_to_budget([prompt, Image.new("RGB", (100, 100))], 50)
+
+    def test_large_image_is_downscaled_to_fit(self):
+        img = Image.new("RGB", (3000, 3000))
+        content, adjusted = fit_to_budget(["Solve this.", img], 1000)
+        self.assertTrue(adjusted)
+        self.assertEqual(content[0], "Solve this.")
+        self.assertLessEqual(estimate_tokens(content), 1000)
+        self.assertEqual(img.size, (3000, 3000))
+
+    def test_over_budget_after_downscaling_is_rejected(self):
+        img = Image.new("RGB", (3000, 3000))
+        with self.assertRaises(TokenBudgetExceeded):
+            fit_to_budget(["x" * 4000, img], 1000)
+
+
+class UsageStoreTests(SimpleTestCase):
+    def test_clients_beyond_the_limit_share_one_bucket(self):
+        store = UsageStore(flush_interval=3600, max_clients=2)
+        for client in ("a", "b", "c", "d"):
+            store.record(UsageScope("classify_message", client), "gemini-2.0-flash")
+        clients = [item["client"] for item in store.rolling()["aggregates"]]
+        self.assertEqual(clients, ["a", "b", OVERFLOW_CLIENT])
+
+    def test_client_slots_are_freed_once_calls_age_out_and_flush(self):
+        store = UsageStore(window_seconds=0.05, flush_interval=3600, max_clients=1)
+        store.record(UsageScope("classify_message", "a"), "gemini-2.0-flash")
+        store.record(UsageScope("classify_message", "b"), "gemini-2.0-flash")
+        with mock.patch("django.db.transaction.atomic"), \
+                mock.patch("api.models.UsageAggregate.objects") as objects:
+            objects.get_or_create.return_value = (mock.Mock(pk=1), True)
+            store.flush()
+        time.sleep(0.1)
+        store.record(UsageScope("classify_message", "c"), "gemini-2.0-flash")
+        self.assertEqual([item["client"] for item in store.rolling()["aggregates"]], ["c"])
+
+    def test_most_expensive_is_picked_after_filtering(self):
+        store = UsageStore(flush_interval=3600, top_n=1)
+        store.record(UsageScope("solve_image_with_prompt", "a"), "gemini-2.0-flash",
+                     SimpleNamespace(prompt_token_count=900, candidates_token_count=100))
+        store.record(UsageScope("classify_message", "b"), "gemini-2.0-flash",
+                     SimpleNamespace(prompt_token_count=10, candidates_token_count=1))
+        recent = store.rolling({"client": "b"})
+        self.assertEqual([item["client"] for item in recent["aggregates"]], ["b"])
+        self.assertEqual([(e["client"], e["total_tokens"]) for e in recent["most_expensive"]], [("b", 11)])
+
+
+class _TrickleHandler(BaseHTTPRequestHandler):
+    """Sends its headers at once, then one body byte every 0.2s."""
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", "100")
+        self.end_headers()
+        try:
+            for _ in range(100):
+                self.wfile.write(b"x")
+                self.wfile.flush()
+                time.sleep(0.2)
+        except OSError:
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _ImageHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/slow.png":
+            return _TrickleHandler.do_GET(self)
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", "4")
+        self.end_headers()
+        self.wfile.write(b"\x89PNG")
+
+    def log_message(self, format, *args):
+        pass
+
+
+class DownloadImageTests(SimpleTestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), _ImageHandler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_download_within_deadline(self):
+        self.assertEqual(_download_image(f"{self.base_url}/image.png", Deadline(5)), b"\x89PNG")
+
+    def test_trickling_server_is_cut_off_at_the_deadline(self):
+        started = time.monotonic()
+        with self.assertRaises(DeadlineExceeded):
+            _download_image(f"{self.base_url}/slow.png", Deadline(1))
+        self.assertLess(time.monotonic() - started, 2)
+
+
+class GenerateQuestionBudgetTests(SimpleTestCase):
+    def test_over_budget_input_is_rejected_in_both_modes(self):
+        payload = {"grade": "8", "subject": "algebra " * 5000, "count": 3}
+        for stream in (False, True):
+            response = self.client.post(
+                "/generate-question", {**payload, "stream": stream}, content_type="application/json"
+            )
+            self.assertEqual(response.status_code, 413)
+            self.assertIn("budget", response.json()["detail"])
+
+
+@override_settings(USAGE_TRUSTED_PROXIES=["10.0.0.1", "10.0.0.2"])
+class UsageScopeTests(SimpleTestCase):
+    def _client_for(self, remote_addr, forwarded=None, client_id=None):
+        extra = {"REMOTE_ADDR": remote_addr}
+        if forwarded is not None:
+            extra["HTTP_X_FORWARDED_FOR"] = forwarded
+        if client_id is not None:
+            extra["HTTP_X_CLIENT_ID"] = client_id
+        request = RequestFactory().get("/", **extra)
+        return _usage_scope(request, "classify_message").client
+
+    def test_headers_from_untrusted_peers_are_ignored(self):
+        self.assertEqual(self._client_for("203.0.113.9", "198.51.100.1", "someone-else"), "203.0.113.9")
+
+    def test_rightmost_untrusted_forwarded_hop_is_the_client(self):
+        # The client forged the first entry; the proxies appended the real one
+        self.assertEqual(self._client_for("10.0.0.2", "1.2.3.4, 203.0.113.9, 10.0.0.1"), "203.0.113.9")
+
+    def test_client_id_from_trusted_proxy_must_be_well_formed(self):
+        self.assertEqual(self._client_for("10.0.0.1", "203.0.113.9", "tenant-42"), "tenant-42")
+        self.assertEqual(self._client_for("10.0.0.1", "203.0.113.9", "x" * 200), "203.0.113.9")
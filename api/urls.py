@@ -7,5 +7,6 @@ urlpatterns = [
     path('check-solution', views.check_solution, name='check_solution'),
     path('classify', views.classify_message, name='classify'),
     path('generate-question', views.generate_math_question, name='generate_question'),
+    path('usage', views.usage_stats, name='usage_stats'),
     
 ]
\ No newline at end of file
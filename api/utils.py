@@ -1,9 +1,15 @@
 import os
 import io
 import sys
+import json
+import time
+import socket
+import threading
+import logging
 from PIL import Image
 from dotenv import load_dotenv
 import google.genai as genai
+from .accounting import UsageScope, TokenBudgetExceeded, fit_to_budget, usage_store
 
 load_dotenv()
 
@@ -16,6 +22,39 @@ if not GEMINI_API_KEY:
 
 _genai_client = genai.Client(api_key=GEMINI_API_KEY)
 
+
+class DeadlineExceeded(Exception):
+    """Raised when a request's time budget runs out before its work is done."""
+
+
+class Deadline:
+    """Time budget shared by every stage of a single request.
+
+    Created once per request from a number of seconds; each downstream call asks
+    for ``timeout()`` so the remaining time shrinks as the request progresses.
+    """
+
+    def __init__(self, seconds: float):
+        self.seconds = float(seconds)
+        self._expires_at = time.monotonic() + self.seconds
+
+    def remaining(self) -> float:
+        return max(0.0, self._expires_at - time.monotonic())
+
+    @property
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def check(self, stage: str = "request"):
+        if self.expired:
+            raise DeadlineExceeded(f"Deadline of {self.seconds:g}s exceeded before {stage}.")
+
+    def timeout(self, stage: str = "request") -> float:
+        """Remaining seconds for the next I/O call; raises if none are left."""
+        self.check(stage)
+        return self.remaining()
+
+
 # Compatibility wrappers to preserve previous GenerativeModel-like interface
 class _ResponseWrapper:
     def __init__(self, raw):
@@ -34,37 +73,149 @@ class _ModelWrapper:
         self._config = generation_config or None
 
     def _to_contents(self, content):
-        # Accept string or [prompt, image]
+        # Accept string or [prompt, image]; returns (contents, image payload bytes)
         from PIL import Image as PILImage
         from google.genai.types import Part
         if isinstance(content, (list, tuple)):
             parts = []
+            image_bytes = 0
             for item in content:
                 if isinstance(item, PILImage.Image):
                     buf = io.BytesIO()
                     item.save(buf, format="PNG")
-                    parts.append(Part.from_bytes(mime_type="image/png", data=buf.getvalue()))
+                    data = buf.getvalue()
+                    image_bytes += len(data)
+                    parts.append(Part.from_bytes(mime_type="image/png", data=data))
                 else:
                     parts.append(str(item))
-            return parts
-        return str(content)
+            return parts, image_bytes
+        return str(content), 0
+
+    def _prepare(self, content, usage: UsageScope | None):
+        """Apply the caller's token budget, then build the request contents."""
+        adjusted = False
+        if usage is not None and usage.token_budget:
+            content, adjusted = fit_to_budget(content, usage.token_budget)
+            if adjusted:
+                logging.info("Images for %s downscaled to a %s-token budget", usage.endpoint, usage.token_budget)
+        contents, image_bytes = self._to_contents(content)
+        return contents, image_bytes, adjusted
 
-    def generate_content(self, content):
-        contents = self._to_contents(content)
+    def _build_config(self, deadline: Deadline | None, extra: dict | None = None) -> dict:
+        config = dict(self._config or {})
+        config.update(extra or {})
+        if deadline is not None:
+            # google-genai takes the HTTP timeout in milliseconds
+            timeout_ms = max(1, int(deadline.timeout(f"{self._model_name} call") * 1000))
+            config["http_options"] = {"timeout": timeout_ms}
+        return config
+
+    def generate_content(self, content, deadline: Deadline | None = None, usage: UsageScope | None = None):
+        contents, image_bytes, adjusted = self._prepare(content, usage)
+        config = self._build_config(deadline)
         try:
             raw = self._client.models.generate_content(
                 model=self._model_name,
                 contents=contents,
-                generation_config=self._config
-            )
-        except TypeError:
-            # Some versions may not support generation_config param
-            raw = self._client.models.generate_content(
-                model=self._model_name,
-                contents=contents
+                config=config or None
             )
+        except Exception as e:
+            if deadline is not None and deadline.expired:
+                raise DeadlineExceeded(f"Deadline of {deadline.seconds:g}s exceeded during {self._model_name} call.") from e
+            raise
+        usage_store.record(usage, self._model_name, getattr(raw, "usage_metadata", None), image_bytes, adjusted)
         return _ResponseWrapper(raw)
 
+    def generate_content_stream(self, content, deadline: Deadline | None = None, config: dict | None = None,
+                                usage: UsageScope | None = None):
+        """Yield response text chunks as the model produces them.
+
+        ``config`` is merged over the model's generation config, e.g. to request
+        schema-constrained JSON output.
+        """
+        contents, image_bytes, adjusted = self._prepare(content, usage)
+        stream = self._client.models.generate_content_stream(
+            model=self._model_name,
+            contents=contents,
+            config=self._build_config(deadline, config) or None
+        )
+        usage_metadata = None
+        try:
+            for chunk in stream:
+                # Token counts arrive with the later chunks; keep the latest
+                usage_metadata = getattr(chunk, "usage_metadata", None) or usage_metadata
+                text = getattr(chunk, "text", None)
+                if text:
+                    yield text
+                if deadline is not None:
+                    deadline.check(f"next {self._model_name} chunk")
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            if deadline is not None and deadline.expired:
+                raise DeadlineExceeded(f"Deadline of {deadline.seconds:g}s exceeded during {self._model_name} stream.") from e
+            raise
+        finally:
+            usage_store.record(usage, self._model_name, usage_metadata, image_bytes, adjusted)
+
+
+class JSONArrayStreamParser:
+    """Incrementally parse a top-level JSON array fed in arbitrary text chunks.
+
+    ``feed()`` returns the array elements completed by that chunk, so callers can
+    act on each item as soon as its closing bracket arrives. Elements that fail
+    to decode are counted in ``errors`` and skipped rather than aborting the rest.
+    """
+
+    def __init__(self):
+        self.errors = 0
+        self.closed = False
+        self._buf = []
+        self._started = False
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+
+    def feed(self, chunk: str) -> list:
+        items = []
+        for ch in chunk:
+            if self.closed:
+                break
+            if not self._started:
+                # Skip anything (e.g. a code fence) before the opening bracket
+                if ch == "[":
+                    self._started = True
+                continue
+            if self._depth == 0:
+                # Between elements: only an element start or the array end matters here
+                if ch in "{[":
+                    self._buf = [ch]
+                    self._depth = 1
+                elif ch == "]":
+                    self.closed = True
+                continue
+            self._buf.append(ch)
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch in "{[":
+                self._depth += 1
+            elif ch in "}]":
+                self._depth -= 1
+                if self._depth == 0:
+                    try:
+                        items.append(json.loads("".join(self._buf)))
+                    except ValueError:
+                        self.errors += 1
+                    self._buf = []
+        return items
+
 # Base models (wrapped to preserve previous API)
 text_model = _ModelWrapper('gemini-2.5-flash', _genai_client)
 
@@ -76,9 +227,11 @@ classification_generation_config = {
 
 classification_model = _ModelWrapper('gemini-2.0-flash', _genai_client, generation_config=classification_generation_config)
 
-def process_math_problem(prompt: str, image_data=None) -> str:
+def process_math_problem(prompt: str, image_data=None, deadline: Deadline | None = None,
+                         usage: UsageScope | None = None) -> str:
     """Process a math problem using Gemini API.
     image_data can be PIL.Image.Image or bytes. When bytes are given, convert to PIL.Image.
+    When a deadline is given, the model call is bounded by its remaining time.
     Returns model text.
     """
     try:
@@ -90,9 +243,9 @@ def process_math_problem(prompt: str, image_data=None) -> str:
             else:
                 img = image_data  # attempt to pass-through
             vision_model = _ModelWrapper('gemini-2.0-flash', _genai_client)
-            response = vision_model.generate_content([prompt, img])
+            response = vision_model.generate_content([prompt, img], deadline=deadline, usage=usage)
         else:
-            response = text_model.generate_content(prompt)
+            response = text_model.generate_content(prompt, deadline=deadline, usage=usage)
         # Prefer response.text
         return getattr(response, "text", "").strip() or str(response)
     except Exception as e:
@@ -167,23 +320,80 @@ import requests
 from PIL import Image
 import io
 
-def process_math_problem_from_url(url: str, prompt: str = None) -> str:
+# Upper bound on a downloaded problem/solution image
+MAX_IMAGE_DOWNLOAD_BYTES = 10 * 1024 * 1024
+IMAGE_DOWNLOAD_CHUNK_BYTES = 8 * 1024
+
+def _abort_download(response):
+    """Cut a streaming download's connection so a read blocked on it returns at once."""
+    try:
+        # Shutting down a duplicate of the descriptor shuts down the shared socket
+        with socket.socket(fileno=os.dup(response.raw.fileno())) as sock:
+            sock.shutdown(socket.SHUT_RDWR)
+    except (OSError, ValueError):
+        pass
+
+def _download_image(url: str, deadline: Deadline | None = None) -> bytes:
+    """Download an image in chunks, stopping at the size cap or when the deadline runs out.
+
+    ``requests`` timeouts only bound each socket read, so a server trickling
+    bytes could keep the download going well past the request's budget. Once
+    the response headers are in, a watchdog timer shuts the connection down
+    when the deadline expires; any error or short body after that point is
+    reported as DeadlineExceeded.
+    """
+    timeout = deadline.timeout("image download") if deadline is not None else None
+    watchdog = None
+    data = bytearray()
+    try:
+        with requests.get(url, timeout=timeout, stream=True) as response:
+            if deadline is not None:
+                watchdog = threading.Timer(deadline.remaining(), _abort_download, args=(response,))
+                watchdog.daemon = True
+                watchdog.start()
+            response.raise_for_status()
+            declared = response.headers.get("Content-Length", "")
+            if declared.isdigit() and int(declared) > MAX_IMAGE_DOWNLOAD_BYTES:
+                raise ValueError(f"Image is larger than {MAX_IMAGE_DOWNLOAD_BYTES} bytes.")
+            for chunk in response.iter_content(chunk_size=IMAGE_DOWNLOAD_CHUNK_BYTES):
+                if deadline is not None:
+                    deadline.check("image download")
+                data.extend(chunk)
+                if len(data) > MAX_IMAGE_DOWNLOAD_BYTES:
+                    raise ValueError(f"Image is larger than {MAX_IMAGE_DOWNLOAD_BYTES} bytes.")
+    except DeadlineExceeded:
+        raise
+    except Exception as e:
+        if deadline is not None and deadline.expired:
+            raise DeadlineExceeded(f"Deadline of {deadline.seconds:g}s exceeded during image download.") from e
+        raise
+    finally:
+        if watchdog is not None:
+            watchdog.cancel()
+    # An aborted connection can also look like a body that simply ended early
+    if deadline is not None:
+        deadline.check("image download")
+    return bytes(data)
+
+def process_math_problem_from_url(url: str, prompt: str = None, deadline: Deadline | None = None,
+                                  usage: UsageScope | None = None) -> str:
     """
     Downloads an image from a given URL, analyzes it as a math problem using Gemini,
     and returns the AI-generated solution text.
+    The download and the model call share the remaining time of ``deadline``.
     """
     try:
         # Download image from URL
-        response = requests.get(url)
-        response.raise_for_status()
-        img = Image.open(io.BytesIO(response.content))
+        img = Image.open(io.BytesIO(_download_image(url, deadline)))
 
         # Default prompt if not given
         if not prompt or not str(prompt).strip():
             prompt = "Solve the math problem contained in this image."
 
         # Reuse the same process_math_problem function for uniform logic
-        solution = process_math_problem(prompt, img)
+        solution = process_math_problem(prompt, img, deadline=deadline, usage=usage)
         return solution
+    except (DeadlineExceeded, TokenBudgetExceeded):
+        raise
     except Exception as e:
         raise RuntimeError(f"Error processing math problem from URL: {str(e)}")
\ No newline at end of file
@@ -3,14 +3,62 @@ import re
 import json
 import requests
 from PIL import Image
-from django.http import HttpResponse, JsonResponse
+from django.conf import settings
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
-from rest_framework.decorators import api_view, parser_classes
+from rest_framework.decorators import api_view, parser_classes, permission_classes
 from rest_framework.parsers import MultiPartParser, FormParser, JSONParser
 from rest_framework import status
-from .utils import process_math_problem, extract_text_from_genai_response, classification_model, text_model
+from rest_framework.permissions import IsAdminUser
+from .utils import process_math_problem, extract_text_from_genai_response, classification_model, text_model, Deadline, JSONArrayStreamParser
+from .accounting import UsageScope, TokenBudgetExceeded, fit_to_budget, usage_store
+from .models import UsageAggregate
 import logging
 
+
+def _request_deadline(request, endpoint: str) -> Deadline:
+    """Build the time budget for a request.
+
+    The endpoint's configured budget is the ceiling; a client may send a smaller
+    one (in seconds) through the ``REQUEST_DEADLINE_HEADER`` header.
+    """
+    budget = float(settings.REQUEST_DEADLINES.get(endpoint, settings.REQUEST_DEADLINE_SECONDS))
+    header = request.headers.get(settings.REQUEST_DEADLINE_HEADER)
+    if header:
+        try:
+            requested = float(header)
+            if requested > 0:
+                budget = min(budget, requested)
+        except (ValueError, TypeError):
+            pass
+    return Deadline(budget)
+
+
+CLIENT_ID_PATTERN = re.compile(r'^[A-Za-z0-9._:-]{1,64}$')
+
+
+def _usage_scope(request, endpoint: str) -> UsageScope:
+    """Identify the endpoint and client a request's model calls are billed to.
+
+    The client id header and X-Forwarded-For are only trusted when the request
+    comes from one of ``USAGE_TRUSTED_PROXIES``; otherwise the remote address is
+    used. The proxy must set (not pass through) the client id header. Proxies
+    append to X-Forwarded-For, so the client is its rightmost entry that is not
+    itself a trusted proxy; entries to the left of it are client-controlled.
+    """
+    remote_addr = request.META.get('REMOTE_ADDR') or 'unknown'
+    client = remote_addr
+    if remote_addr in settings.USAGE_TRUSTED_PROXIES:
+        client_id = (request.headers.get(settings.USAGE_CLIENT_HEADER) or '').strip()
+        hops = [hop.strip() for hop in request.META.get('HTTP_X_FORWARDED_FOR', '').split(',')]
+        forwarded = next((hop for hop in reversed(hops) if hop not in settings.USAGE_TRUSTED_PROXIES), '')
+        if CLIENT_ID_PATTERN.match(client_id):
+            client = client_id
+        elif CLIENT_ID_PATTERN.match(forwarded):
+            client = forwarded
+    return UsageScope(endpoint, client, settings.TOKEN_BUDGETS.get(endpoint))
+
+
 # Root: serve static/index.html if present, otherwise simple redirect-style HTML
 @api_view(['GET'])
 def root(request):
@@ -48,6 +96,8 @@ def solve_image_with_prompt(request):
     import re
     from .utils import process_math_problem, process_math_problem_from_url
 
+    deadline = _request_deadline(request, 'solve_image_with_prompt')
+    usage = _usage_scope(request, 'solve_image_with_prompt')
     data = request.data
     image_url = data.get('url')
     user_prompt = data.get('prompt')
@@ -94,7 +144,10 @@ GUIDELINES:
 
     try:
         # Get AI output
-        solution = process_math_problem_from_url(image_url, final_prompt) if image_url else process_math_problem(final_prompt)
+        solution = (
+            process_math_problem_from_url(image_url, final_prompt, deadline=deadline, usage=usage)
+            if image_url else process_math_problem(final_prompt, deadline=deadline, usage=usage)
+        )
         text = (solution or "").strip().upper()
 
         # 2️⃣ Explicit AI response check for non-math
@@ -147,6 +200,8 @@ GUIDELINES:
 
         return JsonResponse({"status": 0, "solution": solution_content})
 
+    except TokenBudgetExceeded as e:
+        return JsonResponse({"detail": str(e)}, status=413)
     except Exception:
         return JsonResponse({"status": 2, "message": "I am unable to provide the solution."})
 
@@ -160,6 +215,8 @@ GUIDELINES:
 def check_solution(request):
     from .utils import process_math_problem_from_url, process_math_problem
 
+    deadline = _request_deadline(request, 'check_solution')
+    usage = _usage_scope(request, 'check_solution')
     problem_text = request.data.get('problem_text')
     solution_text = request.data.get('solution_text')
     problem_url = request.data.get('problem_url')
@@ -180,9 +237,9 @@ def check_solution(request):
         problem_prompt += "Final answer only:"
 
         if problem_url:
-            correct_solution = process_math_problem_from_url(problem_url, problem_prompt)
+            correct_solution = process_math_problem_from_url(problem_url, problem_prompt, deadline=deadline, usage=usage)
         else:
-            correct_solution = process_math_problem(problem_prompt)
+            correct_solution = process_math_problem(problem_prompt, deadline=deadline, usage=usage)
         correct_solution = (correct_solution or "").strip()
 
         # -----------------------------
@@ -199,9 +256,9 @@ Do not include any explanations.
             check_prompt_base = f"Solution (text): {str(solution_text).strip()}\n\n" + check_prompt_base
 
         if solution_url:
-            raw_result = process_math_problem_from_url(solution_url, check_prompt_base)
+            raw_result = process_math_problem_from_url(solution_url, check_prompt_base, deadline=deadline, usage=usage)
         else:
-            raw_result = process_math_problem(check_prompt_base)
+            raw_result = process_math_problem(check_prompt_base, deadline=deadline, usage=usage)
         raw_result = (raw_result or "").strip()
 
         m = re.search(r'\b(CORRECT|INCORRECT)\b', raw_result, re.IGNORECASE)
@@ -222,9 +279,9 @@ If you cannot determine the final answer, return "UNCLEAR".
             extract_prompt = f"Solution (text): {str(solution_text).strip()}\n\n" + extract_prompt
 
         if solution_url:
-            extracted_raw = process_math_problem_from_url(solution_url, extract_prompt)
+            extracted_raw = process_math_problem_from_url(solution_url, extract_prompt, deadline=deadline, usage=usage)
         else:
-            extracted_raw = process_math_problem(extract_prompt)
+            extracted_raw = process_math_problem(extract_prompt, deadline=deadline, usage=usage)
 
         extracted_solution = (extracted_raw or "").strip()
 
@@ -240,17 +297,90 @@ If you cannot determine the final answer, return "UNCLEAR".
                 "solution_url_provided": bool(solution_url),
             }
         })
+    except TokenBudgetExceeded as e:
+        return JsonResponse({"detail": str(e)}, status=413)
     except Exception as e:
         return JsonResponse({"detail": str(e)}, status=500)
 
 
 
 MAX_QUESTIONS = 20
+MAX_STREAM_ATTEMPTS = 3
+
+# Schema-constrained JSON output for streamed question generation
+QUESTION_STREAM_CONFIG = {
+    "response_mime_type": "application/json",
+    "response_schema": {
+        "type": "ARRAY",
+        "items": {
+            "type": "OBJECT",
+            "properties": {
+                "question": {"type": "STRING"},
+                "answer": {"type": "STRING"},
+            },
+            "required": ["question", "answer"],
+        },
+    },
+}
+
+
+def _stream_question_prompt(grade, subject, missing, previous_questions):
+    prompt = f"""
+You are a math teacher. Generate {missing} unique math questions for a student in grade {grade}
+on the topic of {subject}. Each question should be age-appropriate, clear, and solvable.
+Return a JSON array of exactly {missing} objects with the keys "question" and "answer".
+"""
+    if previous_questions:
+        previous = "\n".join(f"- {q}" for q in previous_questions)
+        prompt += f"\nDo not repeat any of these questions:\n{previous}\n"
+    return prompt
+
+
+def _stream_math_questions(grade, subject, count, deadline, usage):
+    """Yield NDJSON records, one per question, as soon as each is parsed.
+
+    Questions are parsed out of the streamed JSON array one object at a time.
+    If the stream ends short (malformed items, duplicates, errors), only the
+    missing questions are requested again. A final record reports completion.
+    """
+    questions = []
+    attempt = 0
+    while len(questions) < count and attempt < MAX_STREAM_ATTEMPTS and not deadline.expired:
+        attempt += 1
+        prompt = _stream_question_prompt(grade, subject, count - len(questions), questions)
+
+        parser = JSONArrayStreamParser()
+        try:
+            for chunk in text_model.generate_content_stream(prompt, deadline=deadline, config=QUESTION_STREAM_CONFIG, usage=usage):
+                for item in parser.feed(chunk):
+                    q = item.get("question") if isinstance(item, dict) else None
+                    a = item.get("answer") if isinstance(item, dict) else None
+                    if not (isinstance(q, str) and isinstance(a, str)):
+                        continue
+                    q, a = q.strip(), a.strip()
+                    if not q or not a or q in questions or len(questions) >= count:
+                        continue
+                    questions.append(q)
+                    yield json.dumps({"number": len(questions), "question": q, "answer": a}) + "\n"
+        except TokenBudgetExceeded as e:
+            logging.error(f"Question prompt over token budget: {str(e)}")
+            break
+        except Exception as e:
+            logging.error(f"Error streaming questions from AI model: {str(e)}")
+
+    generated = len(questions)
+    for number in range(generated + 1, count + 1):
+        yield json.dumps({"number": number, "question": "Unable to generate question — please retry.", "answer": ""}) + "\n"
+    yield json.dumps({"done": True, "grade": grade, "subject": subject, "count": count, "generated": generated}) + "\n"
+
+
 # This function will generate math questions based on grade and subject provided by the user in the project.
 @csrf_exempt
 @api_view(['POST'])
 @parser_classes([JSONParser, FormParser, MultiPartParser])
 def generate_math_question(request):
+    deadline = _request_deadline(request, 'generate_math_question')
+    usage = _usage_scope(request, 'generate_math_question')
     grade = request.data.get('grade')
     subject = request.data.get('subject')
     count = request.data.get('count', 1)
@@ -272,6 +402,17 @@ def generate_math_question(request):
         if count > MAX_QUESTIONS:
             count = MAX_QUESTIONS
 
+        stream = request.data.get('stream')
+        if isinstance(stream, str):
+            stream = stream.strip().lower() in ("1", "true", "yes")
+        if stream:
+            # Reject over-budget input before the 200 headers go out, as the non-streaming path does
+            fit_to_budget(_stream_question_prompt(grade, subject, count, []), usage.token_budget)
+            return StreamingHttpResponse(
+                _stream_math_questions(grade, subject, count, deadline, usage),
+                content_type='application/x-ndjson'
+            )
+
         questions = []
         try:
             json_prompt = f"""
@@ -289,7 +430,7 @@ Return **only** valid JSON. The JSON must be an array of objects with exactly th
 
 Do NOT include any additional text outside the JSON array. Make sure there are exactly {count} objects.
 """
-            response = text_model.generate_content(json_prompt)
+            response = text_model.generate_content(json_prompt, deadline=deadline, usage=usage)
             text = getattr(response, "text", "").strip() or str(response)
 
             m = re.search(r'(\[.*\])', text, re.DOTALL)
@@ -316,7 +457,7 @@ Do NOT include any additional text outside the JSON array. Make sure there are e
                     questions.append({"question": q.strip(), "answer": a.strip()})
 
             attempt = 0
-            while len(questions) < count and attempt < (count * 2):
+            while len(questions) < count and attempt < (count * 2) and not deadline.expired:
                 attempt += 1
                 single_prompt = f"""
 Generate 1 unique math question for grade {grade} on the topic {subject}.
@@ -325,7 +466,7 @@ Question: ...
 Answer: ...
 Do not repeat previous questions.
 """
-                resp = text_model.generate_content(single_prompt)
+                resp = text_model.generate_content(single_prompt, deadline=deadline, usage=usage)
                 text_single = getattr(resp, "text", "").strip() or str(resp)
                 m2 = re.search(r"Question\s*\d*[:：]\s*(.*?)(?:\r?\n\s*Answer\s*\d*[:：]\s*(.*))?$",
                                text_single, re.DOTALL | re.IGNORECASE)
@@ -341,6 +482,8 @@ Do not repeat previous questions.
                     a = lines[1]
                     if not any(q == e["question"] for e in questions):
                         questions.append({"question": q, "answer": a})
+        except TokenBudgetExceeded:
+            raise
         except Exception as e:
             logging.error(f"Error generating questions from AI model: {str(e)}")
             # Fallback when the AI model fails
@@ -365,6 +508,8 @@ Do not repeat previous questions.
             "count": count,
             "questions": result
         })
+    except TokenBudgetExceeded as e:
+        return JsonResponse({"detail": str(e)}, status=413)
     except Exception as e:
         return JsonResponse({"detail": f"Error generating questions: {str(e)}"}, status=500)
 
@@ -394,7 +539,11 @@ Message: {message}
 Classification:
 """
     try:
-        response = classification_model.generate_content(classification_prompt)
+        response = classification_model.generate_content(
+            classification_prompt,
+            deadline=_request_deadline(request, 'classify_message'),
+            usage=_usage_scope(request, 'classify_message')
+        )
         raw = extract_text_from_genai_response(response).strip()
 
         m = re.search(r'(?<!\d)([01])(?!\d)', raw)
@@ -410,4 +559,22 @@ Classification:
 
         return JsonResponse({"message": message, "classification": 0})
     except Exception as e:
-        return JsonResponse({"detail": f"Error classifying message: {str(e)}"}, status=500)
\ No newline at end of file
+        return JsonResponse({"detail": f"Error classifying message: {str(e)}"}, status=500)
+
+
+# Admin-only view of Gemini token usage: persisted totals plus the rolling in-memory window.
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def usage_stats(request):
+    filters = {
+        key: request.query_params.get(key)
+        for key in ('endpoint', 'model', 'client')
+        if request.query_params.get(key)
+    }
+    try:
+        usage_store.flush()
+        totals = [row.to_dict() for row in UsageAggregate.objects.filter(**filters).order_by('-total_tokens')]
+
+        return JsonResponse({"totals": totals, "recent": usage_store.rolling(filters)})
+    except Exception as e:
+        return JsonResponse({"detail": f"Error reading usage: {str(e)}"}, status=500)
@@ -80,3 +80,38 @@ REST_FRAMEWORK = {
         "rest_framework.renderers.BrowsableAPIRenderer",
     ]
 }
+
+# Per-request time budget (seconds). Every download and model call made while
+# serving a request draws from the same budget. Clients may ask for a shorter
+# budget with the REQUEST_DEADLINE_HEADER header, but never a longer one.
+REQUEST_DEADLINE_SECONDS = float(os.getenv("REQUEST_DEADLINE_SECONDS", "60"))
+REQUEST_DEADLINES = {
+    "solve_image_with_prompt": 60,
+    "check_solution": 90,
+    "classify_message": 20,
+    "generate_math_question": 120,
+}
+REQUEST_DEADLINE_HEADER = "X-Request-Timeout"
+
+# Token accounting. Gemini usage is recorded per endpoint, model and client,
+# kept in memory for USAGE_WINDOW_SECONDS and flushed to the database on the
+# first model call after USAGE_FLUSH_INTERVAL_SECONDS, and when the worker
+# exits. Clients are identified by their remote address; USAGE_CLIENT_HEADER and
+# X-Forwarded-For are only honoured on requests from USAGE_TRUSTED_PROXIES.
+# Those proxies must set USAGE_CLIENT_HEADER themselves, overwriting any value
+# sent by the client. The client address is taken from the rightmost
+# X-Forwarded-For entry that is not a trusted proxy.
+# At most USAGE_MAX_CLIENTS distinct clients are tracked per process.
+USAGE_WINDOW_SECONDS = int(os.getenv("USAGE_WINDOW_SECONDS", "3600"))
+USAGE_FLUSH_INTERVAL_SECONDS = int(os.getenv("USAGE_FLUSH_INTERVAL_SECONDS", "60"))
+USAGE_CLIENT_HEADER = "X-Client-Id"
+USAGE_TRUSTED_PROXIES = [p.strip() for p in os.getenv("USAGE_TRUSTED_PROXIES", "").split(",") if p.strip()]
+USAGE_MAX_CLIENTS = int(os.getenv("USAGE_MAX_CLIENTS", "1000"))
+# Estimated input-token cap per model call. Over-budget images are downscaled;
+# text is never cut, so requests whose text alone is over budget get a 413.
+# The classifier is deliberately absent: moderation must see the whole message.
+TOKEN_BUDGETS = {
+    "solve_image_with_prompt": 8000,
+    "check_solution": 6000,
+    "generate_math_question": 4000,
+}